@@ -1,88 +1,251 @@
 import os
-from datetime import datetime, timedelta
-
+import queue
+import tempfile
+import threading
+from concurrent.futures import Future
+from typing import Annotated
+
+import msgspec
+import numpy as np
+import orjson
 import pandas as pd
-from flask import Flask, jsonify, request
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from flask import Flask, Response, jsonify, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 
 PATH_CSV = "data/raw/db.csv"
+ARROW_STREAM_MIMETYPE = "application/vnd.apache.arrow.stream"
+STREAM_CHUNK_ROWS = 10_000
+SALES_DTYPES = {"year_week": "int32", "vegetable": "category", "sales": "float64"}
+SALES_COLUMN_TYPES = {
+    "year_week": pa.int32(),
+    "vegetable": pa.dictionary(pa.int32(), pa.string()),
+    "sales": pa.float64(),
+}
+GOLD_SCHEMA = pa.schema(
+    [
+        ("year_month", pa.int32()),
+        ("vegetable", pa.dictionary(pa.int32(), pa.string())),
+        ("sales", pa.float64()),
+        ("is_outlier", pa.bool_()),
+    ]
+)
+RAW_SALES_SCHEMA = pa.schema(
+    [("date", pa.string()), ("vegetable", pa.string()), ("kilo_sold", pa.float64())]
+)
+
+TRANSLATIONS = {
+    "tomate": "tomato",
+    "tomatoes": "tomato",
+    "tomaot": "tomato",
+    "tomatto": "tomato",
+    "poire": "pear",
+    "peer": "pear",
+    "pera": "pear",
+    "carotte": "carrot",
+    "zanahoria": "carrot",
+    "pomme de terre": "potato",
+    "patata": "potato",
+    "oignon": "onion",
+    "cebolla": "onion",
+    "poivron": "pepper",
+    "pimiento": "pepper",
+    "brusel sprout": "brussels sprout",
+    "brussel sprout": "brussels sprout",
+    "brussell sprout": "brussels sprout",
+    "brusselsprout": "brussels sprout",
+}
+VEGETABLE_LOOKUP = {name: name for name in TRANSLATIONS.values()} | TRANSLATIONS
+
+
+class SaleRecord(msgspec.Struct):
+    date: Annotated[str, msgspec.Meta(pattern=r"^\d{4}-(0?\d|[1-4]\d|5[0-3])$")]
+    vegetable: str
+    kilo_sold: float
+
+
+SALES_DECODER = msgspec.json.Decoder(list[SaleRecord])
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=self.option), mimetype=self.mimetype
+        )
+
+
+def arrow_stream_response(df: pd.DataFrame, schema: pa.Schema) -> Response:
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(sink.getvalue().to_pybytes(), mimetype=ARROW_STREAM_MIMETYPE)
+
+
+def json_stream_response(df: pd.DataFrame) -> Response:
+    def generate():
+        yield b"["
+        for start in range(0, len(df), STREAM_CHUNK_ROWS):
+            chunk = df.iloc[start : start + STREAM_CHUNK_ROWS]
+            body = orjson.dumps(chunk.to_dict(orient="records"))
+            yield (b"," if start else b"") + body[1:-1]
+        yield b"]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def file_stamp(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_csv_mapped(path: str, column_types: dict[str, pa.DataType]) -> pd.DataFrame:
+    convert_options = pv.ConvertOptions(
+        column_types=column_types, include_columns=list(column_types)
+    )
+    with pa.memory_map(path) as source:
+        table = pv.read_csv(source, convert_options=convert_options)
+    return table.to_pandas(self_destruct=True)
+
+
+def read_parquet_mapped(path: str, filters=None) -> pd.DataFrame:
+    table = pq.read_table(path, memory_map=True, filters=filters)
+    return table.to_pandas(self_destruct=True)
+
+
+def replace_file(path: str, write):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def write_parquet(df: pd.DataFrame, path: str, schema: pa.Schema):
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    replace_file(
+        path, lambda temp_path: pq.write_table(table, temp_path, compression="zstd")
+    )
+
+
+def sales_frame(records: list[SaleRecord]) -> pd.DataFrame:
+    dates = pd.Series([record.date for record in records], dtype=object)
+    year_week = dates.str[:4].astype(np.int32) * 100 + dates.str[5:].astype(np.int32)
+    return pd.DataFrame(
+        {
+            "year_week": year_week,
+            "vegetable": pd.Series(
+                [record.vegetable for record in records], dtype=object
+            ),
+            "sales": np.array(
+                [record.kilo_sold for record in records], dtype=np.float64
+            ),
+        }
+    )
 
 
 def standardize_vegetable_name(name: str) -> str:
-    translations = {
-        "tomate": "tomato",
-        "tomatoes": "tomato",
-        "tomaot": "tomato",
-        "tomatto": "tomato",
-        "poire": "pear",
-        "peer": "pear",
-        "pera": "pear",
-        "carotte": "carrot",
-        "zanahoria": "carrot",
-        "pomme de terre": "potato",
-        "patata": "potato",
-        "oignon": "onion",
-        "cebolla": "onion",
-        "poivron": "pepper",
-        "pimiento": "pepper",
-        "brusel sprout": "brussels sprout",
-        "brussel sprout": "brussels sprout",
-        "brussell sprout": "brussels sprout",
-        "brusselsprout": "brussels sprout",
-    }
-    name = name.lower().strip()
-    return translations.get(name, name)
+    standardized = VEGETABLE_LOOKUP.get(name)
+    if standardized is None:
+        name = name.lower().strip()
+        standardized = TRANSLATIONS.get(name, name)
+    return standardized
 
 
-def compute_monthly_sales(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty:
-        return pd.DataFrame(columns=["year_month", "vegetable", "sales", "is_outlier"])
+def standardize_vegetable_names(names: pd.Series) -> pd.Series:
+    standardized = names.map(VEGETABLE_LOOKUP)
+    missing = standardized.isna()
+    if missing.any():
+        normalized = names[missing].str.lower().str.strip()
+        standardized[missing] = normalized.map(TRANSLATIONS).fillna(normalized)
+    return standardized
 
-    result = []
 
-    for _, row in df.iterrows():
-        year_week = row["year_week"]
-        vegetable = row["vegetable"]
-        sales = row["sales"]
+def split_weeks(year_week: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    year_week = year_week.astype(np.int64)
+    years = year_week // 100
+    weeks = year_week % 100
 
-        year = year_week // 100
-        week = year_week % 100
+    jan_first = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    weekday = (jan_first.astype(np.int64) + 3) % 7
+    first_monday = jan_first + (7 - weekday) % 7
+    start_dates = np.where(
+        weeks == 0, jan_first - weekday, first_monday + (weeks - 1) * 7
+    )
 
-        start_date = datetime.strptime(f"{year}-{week}-1", "%Y-%W-%w")
+    first_month = start_dates.astype("datetime64[M]")
+    next_month_start = (first_month + 1).astype("datetime64[D]")
+    first_days = np.minimum((next_month_start - start_dates).astype(np.int64), 7)
 
-        month_days = {}
+    return month_key(first_month), month_key(first_month + 1), first_days
 
-        for i in range(7):
-            current_date = start_date + timedelta(days=i)
-            month_key = current_date.strftime("%Y%m")
-            month_days[month_key] = month_days.get(month_key, 0) + 1
 
-        for month, days in month_days.items():
-            month_sales = sales * (days / 7.0)
-            result.append(
-                {"year_month": month, "vegetable": vegetable, "sales": month_sales}
-            )
+def month_key(months: np.ndarray) -> np.ndarray:
+    months = months.astype(np.int64)
+    return ((1970 + months // 12) * 100 + months % 12 + 1).astype(np.int32)
 
-    monthly_df = pd.DataFrame(result)
 
-    if not monthly_df.empty:
-        monthly_df = (
-            monthly_df.groupby(["year_month", "vegetable"])["sales"].sum().reset_index()
-        )
+def compute_monthly_sales(df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame(columns=["year_month", "vegetable", "sales", "is_outlier"])
 
-    return monthly_df
+    week_codes, year_weeks = pd.factorize(df["year_week"].to_numpy())
+    first_month, second_month, first_days = (
+        values[week_codes] for values in split_weeks(year_weeks)
+    )
+    vegetable = df["vegetable"].astype("category")
+    vegetable = vegetable.cat.reorder_categories(
+        vegetable.cat.categories.sort_values()
+    ).array
+    sales = df["sales"].to_numpy(dtype=np.float64)
+    spills = first_days < 7
+
+    monthly_df = pd.DataFrame(
+        {
+            "year_month": np.concatenate([first_month, second_month[spills]]),
+            "vegetable": pd.Categorical.from_codes(
+                np.concatenate([vegetable.codes, vegetable.codes[spills]]),
+                dtype=vegetable.dtype,
+            ),
+            "sales": np.concatenate(
+                [
+                    sales * first_days / 7.0,
+                    sales[spills] * (7 - first_days[spills]) / 7.0,
+                ]
+            ),
+        },
+        copy=False,
+    )
+
+    return monthly_df.groupby(
+        ["year_month", "vegetable"], as_index=False, observed=True
+    )["sales"].sum()
 
 
 def tag_outliers(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return df
 
-    df["is_outlier"] = False
-    for vegetable in df["vegetable"].unique():
-        mask = df["vegetable"] == vegetable
-        mean = df.loc[mask, "sales"].mean()
-        std = df.loc[mask, "sales"].std()
-        if not pd.isna(std):
-            df.loc[mask, "is_outlier"] = df.loc[mask, "sales"] > (mean + 5 * std)
+    codes, _ = pd.factorize(df["vegetable"])
+    sales = df["sales"].to_numpy(dtype=np.float64)
+    counts = np.bincount(codes)
+    mean = (np.bincount(codes, weights=sales) / counts)[codes]
+    squares = np.bincount(codes, weights=(sales - mean) ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = np.sqrt(squares / (counts - 1))
+    std[counts < 2] = np.inf
+    df["is_outlier"] = sales > mean + 5 * std[codes]
 
     return df
 
@@ -90,6 +253,7 @@ def tag_outliers(df: pd.DataFrame) -> pd.DataFrame:
 def create_app(config=None):
     config = config or {}
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
 
     if "CSV_PATH" not in config:
         config["CSV_PATH"] = PATH_CSV
@@ -100,162 +264,208 @@ def create_app(config=None):
 
     bronze_path = os.path.join(csv_dir, "bronze_sales.csv")
     silver_path = os.path.join(csv_dir, "silver_sales.csv")
-    gold_path = os.path.join(csv_dir, "gold_sales.csv")
+    gold_path = os.path.join(csv_dir, "gold_sales.parquet")
+    clean_gold_key = (gold_path, "remove_outliers")
+
+    write_lock = threading.RLock()
+    pending_batches = queue.SimpleQueue()
+    seen_keys = {}
+    parsed_cache = {}
+    gold_source = {"silver_stamp": None}
+
+    def read_cached(path, read, *args, key=None):
+        key = key or path
+        stamp = file_stamp(path)
+        cached = parsed_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        with write_lock:
+            stamp = file_stamp(path)
+            df = read(path, *args)
+            parsed_cache[key] = (stamp, df)
+        return df
 
-    @app.route("/init_database", methods=["POST"])
-    def init_database():
-        bronze_df = pd.DataFrame(columns=["year_week", "vegetable", "sales"])
-        silver_df = pd.DataFrame(columns=["year_week", "vegetable", "sales"])
-        gold_df = pd.DataFrame(
-            columns=["year_month", "vegetable", "sales", "is_outlier"]
-        )
+    def load_seen_keys(path):
+        if path not in seen_keys:
+            keys = set()
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                try:
+                    df = read_csv_mapped(
+                        path, {"year_week": pa.int32(), "vegetable": pa.string()}
+                    )
+                    keys = set(zip(df["year_week"], df["vegetable"]))
+                except pa.ArrowInvalid:
+                    pass
+            seen_keys[path] = keys
+        return seen_keys[path]
+
+    def append_new_records(path, df):
+        keys = load_seen_keys(path)
+        df = df.drop_duplicates(["year_week", "vegetable"])
+        is_new = [key not in keys for key in zip(df["year_week"], df["vegetable"])]
+        new_df = df[is_new]
+
+        if not new_df.empty:
+            write_header = not os.path.isfile(path) or os.path.getsize(path) == 0
+            stamp = None if write_header else file_stamp(path)
+            new_df.to_csv(path, mode="a", header=write_header, index=False)
+            keys.update(zip(new_df["year_week"], new_df["vegetable"]))
+
+            cached = parsed_cache.pop(path, None)
+            if cached is not None and cached[0] == stamp:
+                parsed_cache[path] = (
+                    file_stamp(path),
+                    pd.concat([cached[1], new_df], ignore_index=True).astype(
+                        SALES_DTYPES
+                    ),
+                )
 
-        bronze_df.to_csv(bronze_path, index=False)
-        silver_df.to_csv(silver_path, index=False)
-        gold_df.to_csv(gold_path, index=False)
+    def flush_pending_batches():
+        batches = []
+        while True:
+            try:
+                batches.append(pending_batches.get_nowait())
+            except queue.Empty:
+                break
 
-        return jsonify({"status": "Database initialized"}), 200
+        try:
+            append_new_records(bronze_path, pd.concat([batch[0] for batch in batches]))
+            append_new_records(silver_path, pd.concat([batch[1] for batch in batches]))
+        except Exception as e:
+            for _, _, done in batches:
+                done.set_exception(e)
+        else:
+            for _, _, done in batches:
+                done.set_result(None)
 
-    @app.route("/post_sales/", methods=["POST"])
-    def post_sales():
-        data = request.json
-        if not isinstance(data, list):
-            return jsonify({"error": "Data must be a list of records"}), 400
-
-        required_columns = {"date", "vegetable", "kilo_sold"}
-        for record in data:
-            if not isinstance(record, dict) or not all(
-                col in record for col in required_columns
-            ):
-                return jsonify(
-                    {"error": "All records must contain required columns"}
-                ), 400
-
-        transformed_data = []
-        for record in data:
-            date_parts = record["date"].split("-")
-            year = int(date_parts[0])
-            week = int(date_parts[1])
-            year_week = year * 100 + week
-
-            transformed_data.append(
-                {
-                    "year_week": year_week,
-                    "vegetable": record["vegetable"],
-                    "sales": record["kilo_sold"],
-                }
-            )
+    def refresh_gold():
+        if not os.path.isfile(silver_path) or os.path.getsize(silver_path) == 0:
+            return
+        if gold_source["silver_stamp"] == file_stamp(silver_path):
+            return
 
-        for path in [bronze_path, silver_path, gold_path]:
-            if not os.path.exists(path):
-                empty_df = pd.DataFrame()
-                empty_df.to_csv(path, index=False)
+        with write_lock:
+            silver_stamp = file_stamp(silver_path)
+            if gold_source["silver_stamp"] == silver_stamp:
+                return
 
-        if os.path.isfile(bronze_path) and os.path.getsize(bronze_path) > 0:
-            try:
-                bronze_df = pd.read_csv(bronze_path)
-                bronze_df = pd.concat(
-                    [bronze_df, pd.DataFrame(transformed_data)]
-                ).drop_duplicates(subset=["year_week", "vegetable"])
-            except pd.errors.EmptyDataError:
-                bronze_df = pd.DataFrame(transformed_data)
-        else:
-            bronze_df = pd.DataFrame(transformed_data)
+            silver_df = read_cached(silver_path, read_csv_mapped, SALES_COLUMN_TYPES)
 
-        bronze_df.to_csv(bronze_path, index=False)
+            monthly_df = compute_monthly_sales(silver_df)
 
-        silver_data = []
-        for record in transformed_data:
-            silver_data.append(
-                {
-                    "year_week": record["year_week"],
-                    "vegetable": standardize_vegetable_name(record["vegetable"]),
-                    "sales": record["sales"],
-                }
-            )
+            monthly_df = tag_outliers(monthly_df)
 
-        if os.path.isfile(silver_path) and os.path.getsize(silver_path) > 0:
-            try:
-                silver_df = pd.read_csv(silver_path)
-                silver_df = pd.concat(
-                    [silver_df, pd.DataFrame(silver_data)]
-                ).drop_duplicates(subset=["year_week", "vegetable"])
-            except pd.errors.EmptyDataError:
-                silver_df = pd.DataFrame(silver_data)
-        else:
-            silver_df = pd.DataFrame(silver_data)
+            write_parquet(monthly_df, gold_path, GOLD_SCHEMA)
+            parsed_cache.pop(gold_path, None)
+            parsed_cache.pop(clean_gold_key, None)
+            gold_source["silver_stamp"] = silver_stamp
 
-        silver_df.to_csv(silver_path, index=False)
+    def write_batch(bronze_df, silver_df):
+        done = Future()
+        pending_batches.put((bronze_df, silver_df, done))
+        with write_lock:
+            if not done.done():
+                flush_pending_batches()
+        done.result()
 
-        monthly_df = compute_monthly_sales(silver_df)
+    @app.route("/init_database", methods=["POST"])
+    def init_database():
+        bronze_df = pd.DataFrame(columns=["year_week", "vegetable", "sales"])
+        silver_df = pd.DataFrame(columns=["year_week", "vegetable", "sales"])
 
-        monthly_df = tag_outliers(monthly_df)
+        with write_lock:
+            replace_file(bronze_path, lambda path: bronze_df.to_csv(path, index=False))
+            replace_file(silver_path, lambda path: silver_df.to_csv(path, index=False))
+            replace_file(
+                gold_path, lambda path: pq.write_table(GOLD_SCHEMA.empty_table(), path)
+            )
+            seen_keys.clear()
+            parsed_cache.clear()
+            gold_source["silver_stamp"] = file_stamp(silver_path)
 
-        monthly_df.to_csv(gold_path, index=False)
+        return jsonify({"status": "Database initialized"}), 200
+
+    @app.route("/post_sales/", methods=["POST"])
+    def post_sales():
+        try:
+            data = SALES_DECODER.decode(request.get_data())
+        except msgspec.ValidationError as e:
+            return jsonify({"error": f"Invalid records: {e}"}), 400
+        except msgspec.DecodeError:
+            return jsonify({"error": "Data must be a JSON list of records"}), 400
+
+        bronze_df = sales_frame(data)
+        silver_df = bronze_df.assign(
+            vegetable=standardize_vegetable_names(bronze_df["vegetable"])
+        )
+
+        write_batch(bronze_df, silver_df)
 
         return jsonify({"status": "success"}), 200
 
     @app.route("/get_raw_sales/", methods=["GET"])
     def get_raw_sales():
-        if not os.path.isfile(bronze_path) or os.path.getsize(bronze_path) == 0:
-            return jsonify([]), 200
+        df = pd.DataFrame(columns=["year_week", "vegetable", "sales"])
+        if os.path.isfile(bronze_path) and os.path.getsize(bronze_path) > 0:
+            try:
+                df = read_cached(bronze_path, read_csv_mapped, SALES_COLUMN_TYPES)
+            except pa.ArrowInvalid:
+                pass
+
+        year_week = df["year_week"]
+        raw_df = pd.DataFrame(
+            {
+                "date": (year_week // 100).astype(str)
+                + "-"
+                + (year_week % 100).astype(str).str.zfill(2),
+                "vegetable": df["vegetable"],
+                "kilo_sold": df["sales"],
+            }
+        )
 
-        try:
-            df = pd.read_csv(bronze_path)
-
-            result = []
-            for _, row in df.iterrows():
-                year_week = row["year_week"]
-                year = year_week // 100
-                week = year_week % 100
-                date_str = f"{year}-{week:02d}"
-
-                result.append(
-                    {
-                        "date": date_str,
-                        "vegetable": row["vegetable"],
-                        "kilo_sold": row["sales"],
-                    }
-                )
+        best_match = request.accept_mimetypes.best_match(
+            ["application/json", ARROW_STREAM_MIMETYPE]
+        )
+        if best_match == ARROW_STREAM_MIMETYPE:
+            return arrow_stream_response(raw_df, RAW_SALES_SCHEMA), 200
 
-            return jsonify(result), 200
-        except pd.errors.EmptyDataError:
-            return jsonify([]), 200
+        return json_stream_response(raw_df), 200
 
     @app.route("/get_monthly_sales/", methods=["GET"])
     def get_monthly_sales():
         remove_outliers = request.args.get("remove_outliers", "false").lower() == "true"
 
+        refresh_gold()
+
         if not os.path.isfile(gold_path) or os.path.getsize(gold_path) == 0:
             return jsonify([]), 200
 
         try:
-            gold_df = pd.read_csv(gold_path)
-
             if remove_outliers:
-                gold_df = gold_df[~gold_df["is_outlier"]]
-
-            result = []
-            for _, row in gold_df.iterrows():
-                year_month = str(row["year_month"])
-                if len(year_month) == 6:
-                    year = int(year_month[:4])
-                    month = int(year_month[4:])
-                    month_str = f"{year}-{month:02d}"
-                else:
-                    month_str = year_month
-
-                result.append(
-                    {
-                        "date": month_str,
-                        "vegetable": row["vegetable"],
-                        "kilo_sold": row["sales"],
-                        "is_outlier": bool(row["is_outlier"]),
-                    }
+                gold_df = read_cached(
+                    gold_path,
+                    read_parquet_mapped,
+                    [("is_outlier", "=", False)],
+                    key=clean_gold_key,
                 )
+            else:
+                gold_df = read_cached(gold_path, read_parquet_mapped)
+
+            year_month = gold_df["year_month"]
+            result = pd.DataFrame(
+                {
+                    "date": (year_month // 100).astype(str)
+                    + "-"
+                    + (year_month % 100).astype(str).str.zfill(2),
+                    "vegetable": gold_df["vegetable"],
+                    "kilo_sold": gold_df["sales"],
+                    "is_outlier": gold_df["is_outlier"],
+                }
+            ).to_dict(orient="records")
 
             return jsonify(result), 200
-        except pd.errors.EmptyDataError:
+        except pa.ArrowInvalid:
             return jsonify([]), 200
         except Exception as e:
             return jsonify({"error": str(e)}), 500
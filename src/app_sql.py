@@ -1,37 +1,120 @@
+import math
 import os
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+from contextlib import contextmanager
+from typing import Annotated
 
+import msgspec
+import numpy as np
+import orjson
 import pandas as pd
 from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 
 DATABASE_PATH = "data/raw/sales.db"
 
+TRANSLATIONS = {
+    "tomate": "tomato",
+    "tomatoes": "tomato",
+    "tomaot": "tomato",
+    "tomatto": "tomato",
+    "poire": "pear",
+    "peer": "pear",
+    "pera": "pear",
+    "carotte": "carrot",
+    "zanahoria": "carrot",
+    "pomme de terre": "potato",
+    "patata": "potato",
+    "oignon": "onion",
+    "cebolla": "onion",
+    "poivron": "pepper",
+    "pimiento": "pepper",
+    "brusel sprout": "brussels sprout",
+    "brussel sprout": "brussels sprout",
+    "brussell sprout": "brussels sprout",
+    "brusselsprout": "brussels sprout",
+}
+VEGETABLE_LOOKUP = {name: name for name in TRANSLATIONS.values()} | TRANSLATIONS
+
+
+class SaleRecord(msgspec.Struct):
+    date: Annotated[str, msgspec.Meta(pattern=r"^\d{4}-(0?\d|[1-4]\d|5[0-3])$")]
+    vegetable: str
+    kilo_sold: float
+
+
+SALES_DECODER = msgspec.json.Decoder(list[SaleRecord])
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    option = orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self.option).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=self.option), mimetype=self.mimetype
+        )
+
+
+def sales_frame(records: list[SaleRecord]) -> pd.DataFrame:
+    dates = pd.Series([record.date for record in records], dtype=object)
+    year_week = dates.str[:4].astype(np.int32) * 100 + dates.str[5:].astype(np.int32)
+    return pd.DataFrame(
+        {
+            "year_week": year_week,
+            "vegetable": pd.Series(
+                [record.vegetable for record in records], dtype=object
+            ),
+            "sales": np.array(
+                [record.kilo_sold for record in records], dtype=np.float64
+            ),
+        }
+    )
+
 
 def standardize_vegetable_name(name: str) -> str:
-    translations = {
-        "tomate": "tomato",
-        "tomatoes": "tomato",
-        "tomaot": "tomato",
-        "tomatto": "tomato",
-        "poire": "pear",
-        "peer": "pear",
-        "pera": "pear",
-        "carotte": "carrot",
-        "zanahoria": "carrot",
-        "pomme de terre": "potato",
-        "patata": "potato",
-        "oignon": "onion",
-        "cebolla": "onion",
-        "poivron": "pepper",
-        "pimiento": "pepper",
-        "brusel sprout": "brussels sprout",
-        "brussel sprout": "brussels sprout",
-        "brussell sprout": "brussels sprout",
-        "brusselsprout": "brussels sprout",
-    }
-    name = name.lower().strip()
-    return translations.get(name, name)
+    standardized = VEGETABLE_LOOKUP.get(name)
+    if standardized is None:
+        name = name.lower().strip()
+        standardized = TRANSLATIONS.get(name, name)
+    return standardized
+
+
+def standardize_vegetable_names(names: pd.Series) -> pd.Series:
+    standardized = names.map(VEGETABLE_LOOKUP)
+    missing = standardized.isna()
+    if missing.any():
+        normalized = names[missing].str.lower().str.strip()
+        standardized[missing] = normalized.map(TRANSLATIONS).fillna(normalized)
+    return standardized
+
+
+def connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(
+        path, isolation_level=None, uri=path.startswith("file:")
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA cache_size=-65536")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA mmap_size=268435456")
+    return connection
+
+
+@contextmanager
+def transaction(connection, mode="DEFERRED"):
+    connection.execute(f"BEGIN {mode}")
+    try:
+        yield connection.cursor()
+        connection.execute("COMMIT")
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK")
+        raise
 
 
 def create_tables(connection):
@@ -57,230 +140,323 @@ def create_tables(connection):
     )
     """)
 
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_silver_veg_yw
+    ON silver_sales (vegetable, year_week)
+    """)
+
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS gold_sales (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
         year_month TEXT,
         vegetable TEXT,
         sales REAL,
         is_outlier INTEGER,
-        UNIQUE(year_month, vegetable)
+        PRIMARY KEY (year_month, vegetable)
+    ) WITHOUT ROWID
+    """)
+
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_gold_vegetable ON gold_sales (vegetable)
+    """)
+
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS revision (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        value INTEGER
     )
     """)
 
-    connection.commit()
+    cursor.execute("INSERT OR IGNORE INTO revision (id, value) VALUES (0, 0)")
 
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS week_month_days (
+        year_week INTEGER,
+        year_month TEXT,
+        days INTEGER,
+        PRIMARY KEY (year_month, year_week)
+    )
+    """)
 
-def compute_monthly_sales(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty:
-        return pd.DataFrame(columns=["year_month", "vegetable", "sales", "is_outlier"])
+    year_weeks = cursor.execute("""
+    SELECT DISTINCT year_week FROM silver_sales
+    WHERE year_week NOT IN (SELECT year_week FROM week_month_days)
+    """).fetchall()
+    if year_weeks:
+        insert_week_months(cursor, np.array(year_weeks).ravel())
 
-    result = []
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS vegetable_stats (
+        vegetable TEXT PRIMARY KEY,
+        n INTEGER,
+        total REAL,
+        total_sq REAL
+    )
+    """)
 
-    for _, row in df.iterrows():
-        year_week = row["year_week"]
-        vegetable = row["vegetable"]
-        sales = row["sales"]
+    cursor.execute("""
+    INSERT OR IGNORE INTO vegetable_stats (vegetable, n, total, total_sq)
+    SELECT vegetable, COUNT(*), SUM(sales), SUM(sales * sales)
+    FROM gold_sales
+    GROUP BY vegetable
+    """)
 
-        year = year_week // 100
-        week = year_week % 100
 
-        start_date = datetime.strptime(f"{year}-{week}-1", "%Y-%W-%w")
+def split_weeks(year_week: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    year_week = year_week.astype(np.int64)
+    years = year_week // 100
+    weeks = year_week % 100
 
-        month_days = {}
+    jan_first = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]")
+    weekday = (jan_first.astype(np.int64) + 3) % 7
+    first_monday = jan_first + (7 - weekday) % 7
+    start_dates = np.where(
+        weeks == 0, jan_first - weekday, first_monday + (weeks - 1) * 7
+    )
 
-        for i in range(7):
-            current_date = start_date + timedelta(days=i)
-            month_key = current_date.strftime("%Y%m")
-            month_days[month_key] = month_days.get(month_key, 0) + 1
+    first_month = start_dates.astype("datetime64[M]")
+    next_month_start = (first_month + 1).astype("datetime64[D]")
+    first_days = np.minimum((next_month_start - start_dates).astype(np.int64), 7)
 
-        for month, days in month_days.items():
-            month_sales = sales * (days / 7.0)
-            result.append(
-                {"year_month": month, "vegetable": vegetable, "sales": month_sales}
-            )
+    return month_key(first_month), month_key(first_month + 1), first_days
 
-    monthly_df = pd.DataFrame(result)
 
-    if not monthly_df.empty:
-        monthly_df = (
-            monthly_df.groupby(["year_month", "vegetable"])["sales"].sum().reset_index()
-        )
+def month_key(months: np.ndarray) -> np.ndarray:
+    months = months.astype(np.int64)
+    return ((1970 + months // 12) * 100 + months % 12 + 1).astype(np.int32)
 
-    return monthly_df
 
+def insert_week_months(cursor, year_weeks: np.ndarray) -> np.ndarray:
+    year_weeks = np.unique(year_weeks)
+    first_month, second_month, first_days = split_weeks(year_weeks)
+    spills = first_days < 7
+    year_months = np.concatenate([first_month, second_month[spills]])
 
-def tag_outliers(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty:
-        return df
+    cursor.executemany(
+        """
+        INSERT OR IGNORE INTO week_month_days (year_week, year_month, days)
+        VALUES (?, ?, ?)
+        """,
+        zip(
+            np.concatenate([year_weeks, year_weeks[spills]]).tolist(),
+            year_months.astype(str).tolist(),
+            np.concatenate([first_days, 7 - first_days[spills]]).tolist(),
+        ),
+    )
+    return np.unique(year_months)
+
+
+def outlier_threshold(n: int, total: float, total_sq: float) -> float:
+    if n < 2:
+        return math.inf
+
+    mean = total / n
+    variance = max(total_sq - total * mean, 0.0) / (n - 1)
+    return mean + 5 * math.sqrt(variance)
+
+
+def add_gold_stats(cursor, cells: str, params: list, sign: int):
+    cursor.execute(
+        f"""
+        INSERT INTO vegetable_stats (vegetable, n, total, total_sq)
+        SELECT vegetable, ? * COUNT(*), ? * SUM(sales), ? * SUM(sales * sales)
+        FROM gold_sales
+        WHERE {cells}
+        GROUP BY vegetable
+        ON CONFLICT (vegetable) DO UPDATE SET
+            n = n + excluded.n,
+            total = total + excluded.total,
+            total_sq = total_sq + excluded.total_sq
+        """,
+        [sign, sign, sign, *params],
+    )
 
-    df["is_outlier"] = False
-    for vegetable in df["vegetable"].unique():
-        mask = df["vegetable"] == vegetable
-        mean = df.loc[mask, "sales"].mean()
-        std = df.loc[mask, "sales"].std()
-        if not pd.isna(std):
-            df.loc[mask, "is_outlier"] = df.loc[mask, "sales"] > (mean + 5 * std)
 
-    return df
+def update_gold(cursor, year_weeks: np.ndarray, vegetables: list[str]):
+    year_months = insert_week_months(cursor, year_weeks)
+    vegetable_params = ", ".join("?" * len(vegetables))
+    month_params = ", ".join("?" * len(year_months))
+    cells = f"vegetable IN ({vegetable_params}) AND year_month IN ({month_params})"
+    params = [*vegetables, *year_months.astype(str).tolist()]
+
+    add_gold_stats(cursor, cells, params, -1)
+    cursor.execute(
+        f"""
+        INSERT INTO gold_sales (year_month, vegetable, sales, is_outlier)
+        SELECT wm.year_month, s.vegetable, SUM(s.sales * wm.days / 7.0), 0
+        FROM silver_sales s
+        JOIN week_month_days wm USING (year_week)
+        WHERE s.vegetable IN ({vegetable_params})
+        AND wm.year_month IN ({month_params})
+        GROUP BY wm.year_month, s.vegetable
+        ON CONFLICT (year_month, vegetable) DO UPDATE
+        SET sales = excluded.sales, is_outlier = excluded.is_outlier
+        """,
+        params,
+    )
+    add_gold_stats(cursor, cells, params, 1)
+
+    stats = cursor.execute(
+        f"""
+        SELECT vegetable, n, total, total_sq FROM vegetable_stats
+        WHERE vegetable IN ({vegetable_params})
+        """,
+        vegetables,
+    ).fetchall()
+    cursor.executemany(
+        "UPDATE gold_sales SET is_outlier = sales > ? WHERE vegetable = ?",
+        [
+            (outlier_threshold(n, total, total_sq), vegetable)
+            for vegetable, n, total, total_sq in stats
+        ],
+    )
 
 
 def create_app(config=None):
     config = config or {}
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
 
     if "DATABASE_PATH" not in config:
         config["DATABASE_PATH"] = DATABASE_PATH
     app.config.update(config)
 
-    os.makedirs(os.path.dirname(app.config["DATABASE_PATH"]), exist_ok=True)
-
-    with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
+    if not app.config["DATABASE_PATH"].startswith("file:"):
+        os.makedirs(os.path.dirname(app.config["DATABASE_PATH"]), exist_ok=True)
+
+    local = threading.local()
+    write_lock = threading.Lock()
+    response_cache = {}
+
+    def get_connection():
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            connection = connect(app.config["DATABASE_PATH"])
+            local.connection = connection
+        return connection
+
+    conn = get_connection()
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    if journal_mode not in ("wal", "memory"):
+        app.logger.warning("SQLite journal_mode is %s instead of wal", journal_mode)
+    with transaction(conn, "IMMEDIATE"):
         create_tables(conn)
 
+    def cached_response(key, build):
+        (revision,) = get_connection().execute("SELECT value FROM revision").fetchone()
+        etag = f"{key}-{revision}"
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            cached = response_cache.get(key)
+            if cached is None or cached[0] != revision:
+                cached = (revision, orjson.dumps(build()))
+                response_cache[key] = cached
+            response = app.response_class(cached[1], mimetype="application/json")
+
+        response.set_etag(etag)
+        return response
+
     @app.route("/init_database", methods=["POST"])
     def init_database():
-        with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
-            cursor = conn.cursor()
+        conn = get_connection()
+        with write_lock, transaction(conn, "IMMEDIATE") as cursor:
             cursor.execute("DROP TABLE IF EXISTS bronze_sales")
             cursor.execute("DROP TABLE IF EXISTS silver_sales")
             cursor.execute("DROP TABLE IF EXISTS gold_sales")
+            cursor.execute("DROP TABLE IF EXISTS week_month_days")
+            cursor.execute("DROP TABLE IF EXISTS vegetable_stats")
             create_tables(conn)
+            cursor.execute("UPDATE revision SET value = value + 1")
 
         return jsonify({"status": "Database initialized"}), 200
 
     @app.route("/post_sales/", methods=["POST"])
     def post_sales():
-        data = request.json
-        if not isinstance(data, list):
-            return jsonify({"error": "Data must be a list of records"}), 400
-
-        required_columns = {"date", "vegetable", "kilo_sold"}
-        for record in data:
-            if not isinstance(record, dict) or not all(
-                col in record for col in required_columns
-            ):
-                return jsonify(
-                    {"error": "All records must contain required columns"}
-                ), 400
-
-        transformed_data = []
-        for record in data:
-            date_parts = record["date"].split("-")
-            year = int(date_parts[0])
-            week = int(date_parts[1])
-            year_week = year * 100 + week
-
-            transformed_data.append(
-                {
-                    "year_week": year_week,
-                    "vegetable": record["vegetable"],
-                    "sales": record["kilo_sold"],
-                }
+        try:
+            data = SALES_DECODER.decode(request.get_data())
+        except msgspec.ValidationError as e:
+            return jsonify({"error": f"Invalid records: {e}"}), 400
+        except msgspec.DecodeError:
+            return jsonify({"error": "Data must be a JSON list of records"}), 400
+
+        bronze_df = sales_frame(data)
+        year_weeks = bronze_df["year_week"].tolist()
+        sales = bronze_df["sales"].tolist()
+        vegetables = standardize_vegetable_names(bronze_df["vegetable"])
+
+        conn = get_connection()
+        with write_lock, transaction(conn, "IMMEDIATE") as cursor:
+            cursor.executemany(
+                """
+                INSERT INTO bronze_sales (year_week, vegetable, sales)
+                VALUES (?, ?, ?)
+                ON CONFLICT (year_week, vegetable) DO NOTHING
+                """,
+                zip(year_weeks, bronze_df["vegetable"], sales),
+            )
+            if cursor.rowcount > 0:
+                cursor.execute("UPDATE revision SET value = value + 1")
+
+            cursor.executemany(
+                """
+                INSERT INTO silver_sales (year_week, vegetable, sales)
+                VALUES (?, ?, ?)
+                ON CONFLICT (year_week, vegetable) DO NOTHING
+                """,
+                zip(year_weeks, vegetables, sales),
             )
 
-        with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
-            cursor = conn.cursor()
-            for record in transformed_data:
-                cursor.execute(
-                    """
-                    INSERT OR IGNORE INTO bronze_sales (year_week, vegetable, sales)
-                    VALUES (?, ?, ?)
-                    """,
-                    (record["year_week"], record["vegetable"], record["sales"]),
-                )
-
-            for record in transformed_data:
-                std_vegetable = standardize_vegetable_name(record["vegetable"])
-                cursor.execute(
-                    """
-                    INSERT OR IGNORE INTO silver_sales (year_week, vegetable, sales)
-                    VALUES (?, ?, ?)
-                    """,
-                    (record["year_week"], std_vegetable, record["sales"]),
+            if cursor.rowcount > 0:
+                update_gold(
+                    cursor,
+                    bronze_df["year_week"].to_numpy(),
+                    vegetables.unique().tolist(),
                 )
 
-            silver_df = pd.read_sql_query("SELECT * FROM silver_sales", conn)
-
-            if not silver_df.empty:
-                monthly_df = compute_monthly_sales(silver_df)
-
-                monthly_df = tag_outliers(monthly_df)
-
-                for _, row in monthly_df.iterrows():
-                    cursor.execute(
-                        """
-                        INSERT OR REPLACE INTO gold_sales (year_month, vegetable, sales, is_outlier)
-                        VALUES (?, ?, ?, ?)
-                        """,
-                        (
-                            row["year_month"],
-                            row["vegetable"],
-                            row["sales"],
-                            int(row["is_outlier"]),
-                        ),
-                    )
-
-            conn.commit()
-
         return jsonify({"status": "success"}), 200
 
     @app.route("/get_raw_sales/", methods=["GET"])
     def get_raw_sales():
-        with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
-            df = pd.read_sql_query(
-                "SELECT year_week, vegetable, sales FROM bronze_sales", conn
-            )
-
-        result = []
-        for _, row in df.iterrows():
-            year_week = row["year_week"]
-            year = year_week // 100
-            week = year_week % 100
-            date_str = f"{year}-{week:02d}"
-
-            result.append(
-                {
-                    "date": date_str,
-                    "vegetable": row["vegetable"],
-                    "kilo_sold": row["sales"],
-                }
-            )
-
-        return jsonify(result), 200
+        def build():
+            rows = get_connection().execute("""
+                SELECT printf('%d-%02d', year_week / 100, year_week % 100),
+                    vegetable, sales
+                FROM bronze_sales
+            """)
+            return [
+                {"date": date, "vegetable": vegetable, "kilo_sold": sales}
+                for date, vegetable, sales in rows
+            ]
+
+        return cached_response("raw", build)
 
     @app.route("/get_monthly_sales/", methods=["GET"])
     def get_monthly_sales():
         remove_outliers = request.args.get("remove_outliers", "false").lower() == "true"
 
-        with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
-            query = "SELECT year_month, vegetable, sales, is_outlier FROM gold_sales"
+        def build():
+            query = """
+                SELECT substr(year_month, 1, 4) || '-' || substr(year_month, 5),
+                    vegetable, sales, is_outlier
+                FROM gold_sales
+            """
 
             if remove_outliers:
                 query += " WHERE is_outlier = 0"
 
-            df = pd.read_sql_query(query, conn)
-
-            if not df.empty:
-                df["is_outlier"] = df["is_outlier"].astype(bool)
-
-        result = []
-        for _, row in df.iterrows():
-            year_month = row["year_month"]
-            year = int(year_month[:4])
-            month = int(year_month[4:])
-            month_str = f"{year}-{month:02d}"
-
-            result.append(
+            return [
                 {
-                    "date": month_str,
-                    "vegetable": row["vegetable"],
-                    "kilo_sold": row["sales"],
-                    "is_outlier": bool(row["is_outlier"]),
+                    "date": date,
+                    "vegetable": vegetable,
+                    "kilo_sold": sales,
+                    "is_outlier": bool(is_outlier),
                 }
-            )
+                for date, vegetable, sales, is_outlier in get_connection().execute(
+                    query
+                )
+            ]
 
-        return jsonify(result), 200
+        return cached_response("monthly-clean" if remove_outliers else "monthly", build)
 
     return app
 
@@ -1,13 +1,20 @@
 import os
-import sys
 import tempfile
-from pathlib import Path
+import threading
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pytest
 
-sys.path.insert(0, str(Path(__file__).parent.parent))
-from src.app_csv import create_app
+from src import app_csv
+from src.app_csv import (
+    GOLD_SCHEMA,
+    compute_monthly_sales,
+    create_app,
+    tag_outliers,
+    write_parquet,
+)
 
 
 @pytest.fixture
@@ -62,6 +69,20 @@ def test_invalid_data(app):
         assert response.status_code == 400
 
 
+def test_invalid_field_values(app):
+    with app.test_client() as client:
+        for record in [
+            {"date": "2020-54", "vegetable": "tomato", "kilo_sold": 100},
+            {"date": "2020/01", "vegetable": "tomato", "kilo_sold": 100},
+            {"date": "2020-01", "vegetable": "tomato", "kilo_sold": "100"},
+        ]:
+            response = client.post("/post_sales/", json=[record])
+            assert response.status_code == 400
+
+        response = client.get("/get_raw_sales/")
+        assert response.get_json() == []
+
+
 def test_partial_valid_data(app):
     with app.test_client() as client:
         data = [
@@ -74,6 +95,35 @@ def test_partial_valid_data(app):
         assert response.status_code == 400
 
 
+@pytest.mark.parametrize("failing_file", ["bronze_sales.csv", "silver_sales.csv"])
+def test_post_data_retry_after_failed_write(app, monkeypatch, failing_file):
+    failing_path = os.path.join(os.path.dirname(app.config["CSV_PATH"]), failing_file)
+    to_csv = pd.DataFrame.to_csv
+
+    def failing_to_csv(df, path, *args, **kwargs):
+        if path == failing_path:
+            raise OSError("No space left on device")
+        return to_csv(df, path, *args, **kwargs)
+
+    record = [{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}]
+    with app.test_client() as client:
+        monkeypatch.setattr(pd.DataFrame, "to_csv", failing_to_csv)
+        with pytest.raises(OSError):
+            client.post("/post_sales/", json=record)
+
+        monkeypatch.setattr(pd.DataFrame, "to_csv", to_csv)
+        response = client.post("/post_sales/", json=record)
+        assert response.status_code == 200
+
+        response = client.get("/get_raw_sales/")
+        assert response.get_json() == [
+            {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100.0}
+        ]
+
+        response = client.get("/get_monthly_sales/")
+        assert {d["vegetable"] for d in response.get_json()} == {"tomato"}
+
+
 def test_get_raw_sales(app):
     with app.test_client() as client:
         client.post("/init_database")
@@ -93,6 +143,30 @@ def test_get_raw_sales(app):
         assert all(k in data[0] for k in ["date", "vegetable", "kilo_sold"])
 
 
+def test_get_raw_sales_arrow(app):
+    with app.test_client() as client:
+        client.post(
+            "/post_sales/",
+            json=[
+                {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100},
+                {"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150},
+            ],
+        )
+
+        response = client.get(
+            "/get_raw_sales/",
+            headers={"Accept": "application/vnd.apache.arrow.stream"},
+        )
+        assert response.status_code == 200
+        assert response.mimetype == "application/vnd.apache.arrow.stream"
+
+        table = pa.ipc.open_stream(response.data).read_all()
+        assert table.to_pylist() == [
+            {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100.0},
+            {"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150.0},
+        ]
+
+
 def test_get_monthly_sales(app):
     with app.test_client() as client:
         client.post("/init_database")
@@ -119,6 +193,22 @@ def test_get_monthly_sales(app):
         assert all(not d.get("is_outlier", False) for d in data)
 
 
+def test_get_monthly_sales_sorted(app):
+    with app.test_client() as client:
+        client.post(
+            "/post_sales/",
+            json=[
+                {"date": "2020-12", "vegetable": "tomato", "kilo_sold": 100},
+                {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100},
+                {"date": "2020-01", "vegetable": "carrot", "kilo_sold": 100},
+            ],
+        )
+
+        data = client.get("/get_monthly_sales/").get_json()
+        keys = [(d["date"], d["vegetable"]) for d in data]
+        assert keys == sorted(keys)
+
+
 def test_vegetable_name_standardization(app):
     with app.test_client() as client:
         client.post("/init_database")
@@ -151,3 +241,148 @@ def test_init_database(app):
 
         response = client.get("/get_raw_sales/")
         assert len(response.get_json()) == 0
+
+
+def test_get_raw_sales_concurrent_append(monkeypatch, tmp_path):
+    writer_progress = threading.Event()
+    reader_done = threading.Event()
+    rlock = threading.RLock
+
+    class ContendedLock:
+        def __init__(self):
+            self.lock = rlock()
+
+        def __enter__(self):
+            if not self.lock.acquire(blocking=False):
+                writer_progress.set()
+                self.lock.acquire()
+            return self
+
+        def __exit__(self, *exc_info):
+            self.lock.release()
+
+    with monkeypatch.context() as m:
+        m.setattr(threading, "RLock", ContendedLock)
+        app = create_app({"TESTING": True, "CSV_PATH": str(tmp_path / "db.csv")})
+    bronze_path = str(tmp_path / "bronze_sales.csv")
+
+    with app.test_client() as client:
+        client.post("/init_database")
+        client.post(
+            "/post_sales/",
+            json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
+        )
+
+        def post_sales():
+            with app.test_client() as writer_client:
+                writer_client.post(
+                    "/post_sales/",
+                    json=[{"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150}],
+                )
+
+        def get_raw_sales():
+            with app.test_client() as reader_client:
+                reader_client.get("/get_raw_sales/")
+            reader_done.set()
+
+        writer = threading.Thread(target=post_sales)
+        reader = threading.Thread(target=get_raw_sales)
+        read_csv_mapped = app_csv.read_csv_mapped
+        to_csv = pd.DataFrame.to_csv
+
+        def racing_read_csv_mapped(path, column_types):
+            if path == bronze_path and writer.ident is None:
+                writer.start()
+                assert writer_progress.wait(timeout=5)
+            return read_csv_mapped(path, column_types)
+
+        def racing_to_csv(df, path, *args, **kwargs):
+            result = to_csv(df, path, *args, **kwargs)
+            if path == bronze_path:
+                writer_progress.set()
+                assert reader_done.wait(timeout=5)
+            return result
+
+        monkeypatch.setattr(app_csv, "read_csv_mapped", racing_read_csv_mapped)
+        monkeypatch.setattr(pd.DataFrame, "to_csv", racing_to_csv)
+
+        reader.start()
+        reader.join()
+        writer.join()
+        monkeypatch.undo()
+
+        response = client.get("/get_raw_sales/")
+        assert len(response.get_json()) == len(pd.read_csv(bronze_path)) == 2
+
+
+def test_write_parquet_keeps_mapped_readers(tmp_path):
+    path = str(tmp_path / "gold_sales.parquet")
+    old_df = pd.DataFrame(
+        {
+            "year_month": [202001, 202002],
+            "vegetable": ["tomato", "tomato"],
+            "sales": [100.0, 150.0],
+            "is_outlier": [False, False],
+        }
+    )
+    write_parquet(old_df, path, GOLD_SCHEMA)
+
+    with pa.memory_map(path) as source:
+        write_parquet(old_df.iloc[:0], path, GOLD_SCHEMA)
+        assert pq.read_table(source).num_rows == 2
+
+    assert pq.read_table(path).num_rows == 0
+    assert os.listdir(tmp_path) == ["gold_sales.parquet"]
+
+
+def test_compute_monthly_sales_split_week():
+    df = pd.DataFrame(
+        {
+            "year_week": [202004, 202004, 202006],
+            "vegetable": ["tomato", "carrot", "tomato"],
+            "sales": [70.0, 140.0, 35.0],
+        }
+    )
+
+    monthly = compute_monthly_sales(df)
+    result = {
+        (row["year_month"], row["vegetable"]): row["sales"]
+        for row in monthly.to_dict(orient="records")
+    }
+
+    assert result == pytest.approx(
+        {
+            (202001, "tomato"): 50.0,
+            (202002, "tomato"): 55.0,
+            (202001, "carrot"): 100.0,
+            (202002, "carrot"): 40.0,
+        }
+    )
+
+
+def test_tag_outliers_per_vegetable():
+    sales = {
+        "tomato": [10.0 + i % 3 for i in range(30)] + [1000.0],
+        "carrot": [10_000.0 + (i % 5) * 100 for i in range(30)],
+        "onion": [100.0 + (i % 2) * 30 for i in range(26)] + [1000.0],
+        "pear": [1000.0],
+    }
+    df = pd.DataFrame(
+        {
+            "vegetable": [veg for veg, values in sales.items() for _ in values],
+            "sales": [value for values in sales.values() for value in values],
+        }
+    )
+    df.insert(0, "year_month", range(len(df)))
+    grouped = df.groupby("vegetable")["sales"]
+    expected = df["sales"] > grouped.transform("mean") + 5 * grouped.transform("std")
+
+    tagged = tag_outliers(df.copy())
+
+    assert tagged["is_outlier"].tolist() == expected.tolist()
+    assert tagged.loc[tagged["is_outlier"], "vegetable"].tolist() == ["tomato"]
+    assert tagged.loc[tagged["is_outlier"], "sales"].tolist() == [1000.0]
+    assert not tagged.loc[tagged["vegetable"] == "pear", "is_outlier"].item()
+
+    global_threshold = df["sales"].mean() + 5 * df["sales"].std()
+    assert not (df["sales"] > global_threshold).any()
@@ -1,198 +1,333 @@
 import os
 import sqlite3
-import sys
-import tempfile
-from pathlib import Path
+import uuid
 
 import pandas as pd
 import pytest
 
-sys.path.insert(0, str(Path(__file__).parent.parent))
-from src.app_sql import create_app
+from src import app_csv, app_sql
+from src.app_sql import create_app, transaction
 
 
-@pytest.fixture
-def app():
-    temp_db_fd, temp_db_path = tempfile.mkstemp(suffix=".db")
-    os.close(temp_db_fd)
-    config = {"TESTING": True, "DATABASE_PATH": temp_db_path}
-    app = create_app(config)
-    yield app
-    os.unlink(temp_db_path)
+@pytest.fixture(scope="session")
+def database_uri():
+    worker = os.environ.get("PYTEST_XDIST_WORKER", "gw0")
+    return f"file:test_{worker}_{uuid.uuid4().hex}?mode=memory&cache=shared"
 
 
-def test_init_database(app):
-    with app.test_client() as client:
-        client.post(
-            "/post_sales/",
-            json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
-        )
+@pytest.fixture(scope="session")
+def read_conn(database_uri):
+    connection = sqlite3.connect(database_uri, isolation_level=None, uri=True)
+    yield connection
+    connection.close()
 
-        response = client.post("/init_database")
-        assert response.status_code == 200
 
-        with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
-            bronze = pd.read_sql_query("SELECT * FROM bronze_sales", conn)
-            silver = pd.read_sql_query("SELECT * FROM silver_sales", conn)
-            gold = pd.read_sql_query("SELECT * FROM gold_sales", conn)
+@pytest.fixture(scope="session")
+def app(database_uri, read_conn):
+    config = {"TESTING": True, "DATABASE_PATH": database_uri}
+    return create_app(config)
 
-            assert len(bronze) == 0
-            assert len(silver) == 0
-            assert len(gold) == 0
 
+@pytest.fixture(autouse=True)
+def reset_database(app):
+    app.test_client().post("/init_database")
 
-def test_post_sales_idempotence(app):
-    with app.test_client() as client:
-        client.post("/init_database")
 
-        response = client.post(
-            "/post_sales/",
-            json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
-        )
-        assert response.status_code == 200
+@pytest.fixture
+def client(app):
+    with app.test_client() as client:
+        yield client
 
-        response = client.post(
-            "/post_sales/",
-            json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
-        )
-        assert response.status_code == 200
 
-        with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
-            bronze = pd.read_sql_query("SELECT * FROM bronze_sales", conn)
-            assert len(bronze) == 1
+def test_init_database(client, read_conn):
+    client.post(
+        "/post_sales/",
+        json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
+    )
 
+    response = client.post("/init_database")
+    assert response.status_code == 200
 
-def test_invalid_data_sql(app):
-    with app.test_client() as client:
-        response = client.post(
-            "/post_sales/",
-            json=[{"date": "2020-01"}],
-        )
-        assert response.status_code == 400
+    for table in ("bronze_sales", "silver_sales", "gold_sales"):
+        (n,) = read_conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+        assert n == 0
 
 
-def test_partial_invalid_data_sql(app):
-    with app.test_client() as client:
-        client.post("/init_database")
+def test_post_sales_idempotence(client, read_conn):
+    response = client.post(
+        "/post_sales/",
+        json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
+    )
+    assert response.status_code == 200
 
-        data = [
-            {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100},
-            {"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150},
-            {"date": "2020-03"},
-            {"date": "2020-04", "vegetable": "potato", "kilo_sold": 200},
-        ]
-        response = client.post("/post_sales/", json=data)
-        assert response.status_code == 400
+    response = client.post(
+        "/post_sales/",
+        json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
+    )
+    assert response.status_code == 200
 
-        with sqlite3.connect(app.config["DATABASE_PATH"]) as conn:
-            bronze = pd.read_sql_query("SELECT * FROM bronze_sales", conn)
-            assert len(bronze) == 0
+    (n,) = read_conn.execute("SELECT COUNT(*) FROM bronze_sales").fetchone()
+    assert n == 1
 
 
-def test_get_raw_sales_sql(app):
-    with app.test_client() as client:
-        client.post("/init_database")
+def test_invalid_data_sql(client):
+    response = client.post(
+        "/post_sales/",
+        json=[{"date": "2020-01"}],
+    )
+    assert response.status_code == 400
 
-        client.post(
-            "/post_sales/",
-            json=[
-                {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100},
-                {"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150},
-            ],
-        )
 
-        response = client.get("/get_raw_sales/")
-        assert response.status_code == 200
-
-        data = response.get_json()
-        assert len(data) == 2
-        assert all(k in data[0] for k in ["date", "vegetable", "kilo_sold"])
+def test_invalid_field_values_sql(client):
+    for record in [
+        {"date": "2020-54", "vegetable": "tomato", "kilo_sold": 100},
+        {"date": "2020/01", "vegetable": "tomato", "kilo_sold": 100},
+        {"date": "2020-01", "vegetable": "tomato", "kilo_sold": "100"},
+    ]:
+        response = client.post("/post_sales/", json=[record])
+        assert response.status_code == 400
 
+    response = client.get("/get_raw_sales/")
+    assert response.get_json() == []
 
-def test_get_monthly_sales_sql(app):
-    with app.test_client() as client:
-        client.post("/init_database")
 
-        test_data = [
-            {"date": "2020-01", "vegetable": "tomate", "kilo_sold": 100},
-            {"date": "2020-02", "vegetable": "tomato", "kilo_sold": 150},
-            {
-                "date": "2020-03",
-                "vegetable": "tomatoes",
-                "kilo_sold": 1000,
-            },
-            {"date": "2020-04", "vegetable": "carrot", "kilo_sold": 200},
-        ]
-        client.post("/post_sales/", json=test_data)
+def test_partial_invalid_data_sql(client, read_conn):
+    data = [
+        {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100},
+        {"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150},
+        {"date": "2020-03"},
+        {"date": "2020-04", "vegetable": "potato", "kilo_sold": 200},
+    ]
+    response = client.post("/post_sales/", json=data)
+    assert response.status_code == 400
 
-        response = client.get("/get_monthly_sales/")
-        assert response.status_code == 200
+    (n,) = read_conn.execute("SELECT COUNT(*) FROM bronze_sales").fetchone()
+    assert n == 0
 
-        data = response.get_json()
-        assert len(data) > 0
-        assert all(
-            veg in ["tomato", "carrot"] for d in data for veg in [d["vegetable"]]
-        )
 
-        response = client.get("/get_monthly_sales/?remove_outliers=true")
+def test_get_raw_sales_sql(client):
+    client.post(
+        "/post_sales/",
+        json=[
+            {"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100},
+            {"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150},
+        ],
+    )
+
+    response = client.get("/get_raw_sales/")
+    assert response.status_code == 200
+
+    data = response.get_json()
+    assert len(data) == 2
+    assert all(k in data[0] for k in ["date", "vegetable", "kilo_sold"])
+
+
+def test_get_monthly_sales_sql(client):
+    test_data = [
+        {"date": "2020-01", "vegetable": "tomate", "kilo_sold": 100},
+        {"date": "2020-02", "vegetable": "tomato", "kilo_sold": 150},
+        {
+            "date": "2020-03",
+            "vegetable": "tomatoes",
+            "kilo_sold": 1000,
+        },
+        {"date": "2020-04", "vegetable": "carrot", "kilo_sold": 200},
+    ]
+    client.post("/post_sales/", json=test_data)
+
+    response = client.get("/get_monthly_sales/")
+    assert response.status_code == 200
+
+    data = response.get_json()
+    assert len(data) > 0
+    assert all(veg in ["tomato", "carrot"] for d in data for veg in [d["vegetable"]])
+
+    response = client.get("/get_monthly_sales/?remove_outliers=true")
+    assert response.status_code == 200
+
+    data = response.get_json()
+    assert all(not d.get("is_outlier", False) for d in data)
+
+
+def read_gold(read_conn):
+    return read_conn.execute(
+        """
+        SELECT year_month, vegetable, sales, is_outlier FROM gold_sales
+        ORDER BY year_month, vegetable
+        """
+    ).fetchall()
+
+
+def assert_stats_match_gold(read_conn):
+    stats = read_conn.execute(
+        "SELECT vegetable, n, total, total_sq FROM vegetable_stats ORDER BY vegetable"
+    ).fetchall()
+    expected = read_conn.execute(
+        """
+        SELECT vegetable, COUNT(*), SUM(sales), SUM(sales * sales) FROM gold_sales
+        GROUP BY vegetable ORDER BY vegetable
+        """
+    ).fetchall()
+    assert [row[:2] for row in stats] == [row[:2] for row in expected]
+    for row, expected_row in zip(stats, expected):
+        assert row[2:] == pytest.approx(expected_row[2:])
+
+
+def test_outliers_across_batches_sql(client, read_conn):
+    records = [
+        {
+            "date": f"{year}-{week:02d}",
+            "vegetable": "tomato",
+            "kilo_sold": 5000 if (year, week) == (2021, 20) else 70,
+        }
+        for year in (2020, 2021, 2022)
+        for week in range(1, 53)
+    ]
+    client.post("/post_sales/", json=records)
+    single_batch_gold = read_gold(read_conn)
+    assert len(single_batch_gold) == 37
+
+    client.post("/init_database")
+    batches = [records[i::6] for i in range(6)]
+    for batch in batches:
+        response = client.post("/post_sales/", json=batch)
         assert response.status_code == 200
+        assert_stats_match_gold(read_conn)
+    assert read_gold(read_conn) == single_batch_gold
 
-        data = response.get_json()
-        assert all(not d.get("is_outlier", False) for d in data)
+    data = client.get("/get_monthly_sales/").get_json()
+    assert [(d["date"], d["vegetable"]) for d in data if d["is_outlier"]] == [
+        ("2021-05", "tomato")
+    ]
 
+    clean = client.get("/get_monthly_sales/?remove_outliers=true").get_json()
+    assert len(clean) == len(data) - 1
+    assert "2021-05" not in {d["date"] for d in clean}
 
-def test_vegetable_name_standardization_sql(app):
-    with app.test_client() as client:
-        client.post("/init_database")
+    response = client.post("/post_sales/", json=batches[2])
+    assert response.status_code == 200
+    assert read_gold(read_conn) == single_batch_gold
+    assert_stats_match_gold(read_conn)
+    (n,) = read_conn.execute("SELECT COUNT(*) FROM bronze_sales").fetchone()
+    assert n == len(records)
 
-        test_data = [
-            {"date": "2020-01", "vegetable": "tomate", "kilo_sold": 100},
-            {"date": "2020-01", "vegetable": "carotte", "kilo_sold": 150},
-            {"date": "2020-01", "vegetable": "patata", "kilo_sold": 200},
-            {"date": "2020-01", "vegetable": "pera", "kilo_sold": 250},
-            {"date": "2020-01", "vegetable": "brussel sprout", "kilo_sold": 300},
-        ]
-        client.post("/post_sales/", json=test_data)
 
-        response = client.get("/get_monthly_sales/")
-        data = response.get_json()
+def test_post_sales_single_transaction(client, monkeypatch):
+    statements = []
+    connections = []
+    transaction = app_sql.transaction
 
-        vegetables = {d["vegetable"] for d in data}
-        assert vegetables.issubset(
-            {"tomato", "carrot", "potato", "pear", "brussels sprout"}
-        )
+    def traced_transaction(connection, mode="DEFERRED"):
+        connection.set_trace_callback(statements.append)
+        connections.append(connection)
+        return transaction(connection, mode)
 
+    monkeypatch.setattr(app_sql, "transaction", traced_transaction)
 
-def test_extended_translations(app):
-    with app.test_client() as client:
-        client.post("/init_database")
-
-        test_data = [
-            {
-                "date": "2020-01",
-                "vegetable": "tomatto",
-                "kilo_sold": 100,
-            },
-            {
-                "date": "2020-01",
-                "vegetable": "tomaot",
-                "kilo_sold": 150,
-            },
-            {
-                "date": "2020-01",
-                "vegetable": "peer",
-                "kilo_sold": 200,
-            },
-            {
-                "date": "2020-01",
-                "vegetable": "brusselsprout",
-                "kilo_sold": 250,
-            },
-        ]
-        client.post("/post_sales/", json=test_data)
-
-        response = client.get("/get_monthly_sales/")
-        data = response.get_json()
-
-        vegetables = {d["vegetable"] for d in data}
-        assert vegetables.issubset({"tomato", "pear", "brussels sprout"})
+    response = client.post(
+        "/post_sales/",
+        json=[
+            {"date": "2020-01", "vegetable": "tomate", "kilo_sold": 100},
+            {"date": "2020-02", "vegetable": "tomato", "kilo_sold": 150},
+            {"date": "2020-03", "vegetable": "carotte", "kilo_sold": 1000},
+            {"date": "2020-04", "vegetable": "carrot", "kilo_sold": 200},
+        ],
+    )
+    assert response.status_code == 200
+
+    for connection in connections:
+        connection.set_trace_callback(None)
+
+    assert len(connections) == 1
+    assert statements[0] == "BEGIN IMMEDIATE"
+    assert statements.count("COMMIT") == 1
+    assert statements[-1] == "COMMIT"
+
+
+def test_transaction_rolls_back_failed_commit(tmp_path):
+    path = str(tmp_path / "sales.db")
+    writer = sqlite3.connect(path, isolation_level=None, timeout=0.01)
+    writer.execute("CREATE TABLE sales (value INTEGER)")
+    reader = sqlite3.connect(path, isolation_level=None)
+    reader.execute("BEGIN")
+    reader.execute("SELECT * FROM sales").fetchall()
+
+    with (
+        pytest.raises(sqlite3.OperationalError, match="locked"),
+        transaction(writer, "IMMEDIATE") as cursor,
+    ):
+        cursor.execute("INSERT INTO sales VALUES (1)")
+    assert not writer.in_transaction
+
+    reader.execute("COMMIT")
+    with transaction(writer, "IMMEDIATE") as cursor:
+        cursor.execute("INSERT INTO sales VALUES (2)")
+    assert reader.execute("SELECT value FROM sales").fetchall() == [(2,)]
+
+    reader.close()
+    writer.close()
+
+
+def test_vegetable_name_standardization_sql(client):
+    test_data = [
+        {"date": "2020-01", "vegetable": "tomate", "kilo_sold": 100},
+        {"date": "2020-01", "vegetable": "carotte", "kilo_sold": 150},
+        {"date": "2020-01", "vegetable": "patata", "kilo_sold": 200},
+        {"date": "2020-01", "vegetable": "pera", "kilo_sold": 250},
+        {"date": "2020-01", "vegetable": "brussel sprout", "kilo_sold": 300},
+    ]
+    client.post("/post_sales/", json=test_data)
+
+    response = client.get("/get_monthly_sales/")
+    data = response.get_json()
+
+    vegetables = {d["vegetable"] for d in data}
+    assert vegetables == {"tomato", "carrot", "potato", "pear", "brussels sprout"}
+
+
+@pytest.mark.parametrize(
+    "raw,expected",
+    [
+        ("tomate", "tomato"),
+        ("carotte", "carrot"),
+        ("patata", "potato"),
+        ("pera", "pear"),
+        ("brussel sprout", "brussels sprout"),
+        ("tomatto", "tomato"),
+        ("tomaot", "tomato"),
+        ("peer", "pear"),
+        ("brusselsprout", "brussels sprout"),
+    ],
+)
+@pytest.mark.parametrize("module", [app_csv, app_sql], ids=["csv", "sql"])
+def test_vegetable_standardization(module, raw, expected):
+    assert module.standardize_vegetable_name(raw) == expected
+    assert module.standardize_vegetable_names(pd.Series([raw])).tolist() == [expected]
+
+
+def test_get_sales_etag_sql(client):
+    client.post(
+        "/post_sales/",
+        json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
+    )
+
+    response = client.get("/get_raw_sales/")
+    etag = response.headers["ETag"]
+
+    response = client.get("/get_raw_sales/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    client.post(
+        "/post_sales/",
+        json=[{"date": "2020-01", "vegetable": "tomato", "kilo_sold": 100}],
+    )
+    response = client.get("/get_raw_sales/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    client.post(
+        "/post_sales/",
+        json=[{"date": "2020-02", "vegetable": "carrot", "kilo_sold": 150}],
+    )
+    response = client.get("/get_raw_sales/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert len(response.get_json()) == 2